@@ -9,10 +9,10 @@ Determine attestations
 """
 
 from airtight.cli import configure_commandline
-import json
 import logging
 from pathlib import Path
 from pprint import pformat, pprint
+from records import iter_records
 
 logger = logging.getLogger(__name__)
 
@@ -47,15 +47,15 @@ def main(**kwargs):
     """
     # logger = logging.getLogger(sys._getframe().f_code.co_name)
     whence = Path(kwargs["from"]).expanduser().resolve()
-    with open(whence, "r", encoding="utf-8") as fp:
-        raw_data = json.load(fp)
-    del fp
-    documents = {d["id-in-this-doc"]: d for d in raw_data}
-    del raw_data
-    logger.info(f"Read {len(documents)} document objects from file")
     dates = dict()
     fieldnames = ["king", "regnal-year", "month", "day"]
-    for docid, docdata in documents.items():
+    projection = (
+        ["id-in-this-doc"] + fieldnames + [f"{fn}-comment" for fn in fieldnames]
+    )
+    count = 0
+    for docdata in iter_records(whence, projection):
+        count += 1
+        docid = docdata["id-in-this-doc"]
         skip = False
         for fn in fieldnames:
             try:
@@ -106,6 +106,7 @@ def main(**kwargs):
             finally:
                 month[docdata["day"]].append(docid)
 
+    logger.info(f"Read {count} document objects from file")
     pprint(dates, indent=4)
 
 
@@ -10,13 +10,22 @@ Convert 'combined' data in CSV+UTF8 to JSON with basic cleanup
 
 from csv import DictWriter
 from airtight.cli import configure_commandline
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import csv
+from glob import glob
+import os
+import hashlib
+import heapq
 import json
 import logging
 from pathlib import Path
 from pprint import pformat
 import re
 from slugify import slugify
+import sqlite3
+from tempfile import TemporaryDirectory, TemporaryFile
+from time import perf_counter
 
 logger = logging.getLogger(__name__)
 vocabularies = dict()
@@ -54,6 +63,7 @@ boolean_fields = {
 }
 boolean_values = {"Yes": True, "x": True, "?": False, "TRUE": True}
 integer_fields = {"king-order"}
+chronological_fields = ["king-order", "regnal-year", "month", "day"]
 regex_fields = {
     "actual-date-attestation": [
         re.compile(
@@ -77,6 +87,30 @@ regex_fields = {
     "uri": [re.compile(r"^http://cdli.ucla.edu/P\d+$")],
 }
 dedupe_fields = {"museum-labels", "publication-labels"}
+attestation_fields = {"king", "regnal-year", "month", "day"}
+roman_months = {
+    "I": 1,
+    "II": 2,
+    "III": 3,
+    "IV": 4,
+    "V": 5,
+    "VI": 6,
+    "VII": 7,
+    "VIII": 8,
+    "IX": 9,
+    "X": 10,
+    "XI": 11,
+    "XII": 12,
+}
+rx_attestation = re.compile(
+    r"^(?P<king>Ph Ar|SE|[A-Z][a-z]+(?: (?:I+|IV))?) (?P<year>\d+) "
+    r"(?P<month>XII|XI|IX|X|VIII|VII|VI|IV|V|III|II|I)(?P<intercalary>2)?"
+    r"(?: (?P<day>\d+)\??| \[(?P<restored_day>\d+)\])?(?: = .*)?$"
+)
+king_lookup = None
+reign_bounds = None
+MAX_OPEN_SPILLS = 64
+HASH_CHUNK_SIZE = 1 << 16
 
 
 DEFAULT_LOG_LEVEL = logging.WARNING
@@ -105,12 +139,60 @@ OPTIONAL_ARGUMENTS = [
         "very verbose output (logging level == DEBUG)",
         False,
     ],
-    ["-f", "--format", "json", "output format (json or csv)", False],
+    [
+        "-f",
+        "--format",
+        "json",
+        "output format (json, jsonl or csv); jsonl also writes a sidecar .idx offset index",
+        False,
+    ],
+    [
+        "-k",
+        "--partition",
+        "",
+        "write one shard per value of this field (e.g. king or source) into the destination directory, with a manifest",
+        False,
+    ],
+    [
+        "-s",
+        "--sort",
+        "",
+        "sort output records (chronological: by king-order, regnal-year, month and day)",
+        False,
+    ],
+    [
+        "-b",
+        "--sort-buffer",
+        100000,
+        "maximum number of records to sort in memory before spilling a sorted run to disk",
+        False,
+    ],
+    [
+        "-j",
+        "--jobs",
+        0,
+        "number of worker processes for multiple sources (0 for one per CPU)",
+        False,
+    ],
+    [
+        "-d",
+        "--dedupe-across",
+        False,
+        "check for possible duplicates across all sources rather than within each",
+        False,
+    ],
+    [
+        "-m",
+        "--dedupe-on-disk",
+        False,
+        "check for possible duplicates with an on-disk SQLite slug index to bound memory use",
+        False,
+    ],
 ]
 POSITIONAL_ARGUMENTS = [
     # each row is a list with 3 elements: name, type, help
-    ["from", str, "source CSV file"],
-    ["to", str, "destination filename"],
+    ["from", str, "source CSV file, or directory or glob of source CSV files"],
+    ["to", str, "destination filename, or directory for a directory or glob"],
 ]
 
 
@@ -177,7 +259,11 @@ def convert_field(fieldname, value):
 
 def convert_rows(rows: list, fn_crosswalk: dict):
     """Convert a list of dictionaries to a list of JSON-compatible objects using the crosswalk"""
-    objs = list()
+    return list(iter_converted_rows(rows, fn_crosswalk))
+
+
+def iter_converted_rows(rows, fn_crosswalk: dict):
+    """Yield a JSON-compatible object for each dictionary in rows, one at a time"""
     integer_failures = set()
     for i, row in enumerate(rows):
         obj = dict()
@@ -230,8 +316,7 @@ def convert_rows(rows: list, fn_crosswalk: dict):
                         obj[obj_k].append(clean_v)
                     else:
                         obj[obj_k] = [previous_value, clean_v]
-        objs.append(obj)
-    return objs
+        yield obj
 
 
 def get_vocab(fieldname: str):
@@ -264,122 +349,801 @@ def get_vocab(fieldname: str):
     return vocab
 
 
-def validate_objects(objs: list, halt_on_error: bool):
-    for i, obj in enumerate(objs):
-        for k, v in obj.items():
-            if k in skip_fields:
+def validate_object(obj: dict, i: int):
+    """Return messages for values in a single object not found in the vocabularies."""
+    msgs = list()
+    for k, v in obj.items():
+        if k in skip_fields:
+            continue
+        if k in integer_fields:
+            if not isinstance(v, int):
+                raise ValueError("gack")
+            else:
                 continue
-            if k in integer_fields:
-                if not isinstance(v, int):
-                    raise ValueError("gack")
-                else:
-                    continue
-            elif k in boolean_fields:
-                if not isinstance(v, bool):
-                    raise ValueError("gork")
-                else:
-                    continue
-            elif k in regex_fields:
+        elif k in boolean_fields:
+            if not isinstance(v, bool):
+                raise ValueError("gork")
+            else:
                 continue
-            vocab = get_vocab(k)
-            if vocab is not None:
-                try:
-                    vocab[v]
-                except KeyError:
-                    msg = f"Invalid value '{v}' in field '{k}' for object at sequence {i}."
-                    if halt_on_error:
-                        raise ValueError(msg)
-                    else:
-                        logger.error(msg)
+        elif k in regex_fields:
+            continue
+        vocab = get_vocab(k)
+        if vocab is not None:
+            try:
+                vocab[v]
+            except KeyError:
+                msgs.append(
+                    f"Invalid value '{v}' in field '{k}' for object at sequence {i}."
+                )
+    return msgs
 
 
-def check_duplicates(objs: list):
-    index = dict()
-    obj_lookup = dict()
-    for obj in objs:
+def get_king_lookup():
+    """Get precompiled lookup from king acronym to king ID."""
+    global king_lookup
+    if king_lookup is None:
+        king_lookup = build_king_lookup(get_converter("king"))
+    return king_lookup
+
+
+def build_king_lookup(converter):
+    """Build a lookup from king acronym to king ID from the king converter and fodder."""
+    lookup = dict()
+    if converter is not None:
+        for acronym, converter_object in converter.items():
+            try:
+                lookup[acronym] = converter_object["conversion"]
+            except KeyError:
+                continue
+    fpath = Path(__file__).parent.parent / "data" / "vocabularies" / "king_fodder.csv"
+    logger.debug(fpath)
+    logger.info("Loading from file: king fodder for king lookup.")
+    groups = dict()
+    with open(fpath, "r", encoding="utf-8-sig") as fp:
+        reader = csv.DictReader(fp)
+        for row in reader:
+            order = row["King Order"].strip()
+            acronym = row["King Acronym"].strip()
+            if order.isdigit() and acronym:
+                groups.setdefault(order, set()).add(acronym)
+    del fp
+    # acronyms sharing a king order in the fodder name the same king
+    for acronyms in groups.values():
+        king_ids = {lookup[a] for a in acronyms if a in lookup}
+        if len(king_ids) == 1:
+            king_id = king_ids.pop()
+            for acronym in acronyms:
+                lookup.setdefault(acronym, king_id)
+    for acronym, king_id in list(lookup.items()):
+        lookup.setdefault(acronym.replace(" ", ""), king_id)
+    return lookup
+
+
+def parse_attestation(value: str):
+    """Parse an actual-date-attestation string into king, regnal-year, month and day."""
+    match = rx_attestation.match(value)
+    if match is None:
+        return None
+    acronym = match.group("king")
+    lookup = get_king_lookup()
+    try:
+        king = lookup[acronym]
+    except KeyError:
+        king = lookup.get(acronym.replace(" ", ""))
+    month = f"{roman_months[match.group('month')]:02}"
+    if match.group("intercalary"):
+        month += "INT"
+    day = match.group("day") or match.group("restored_day")
+    if day is not None:
+        day = int(day)
+    return {
+        "king": king,
+        "regnal-year": int(match.group("year")),
+        "month": month,
+        "day": day,
+    }
+
+
+def check_attestation(obj: dict, i: int):
+    """Return messages for date fields that disagree with the object's attestation."""
+    msgs = list()
+    try:
+        attestation = obj["actual-date-attestation"]
+    except KeyError:
+        return msgs
+    if not isinstance(attestation, str):
+        return msgs
+    parsed = parse_attestation(attestation)
+    if parsed is None:
+        return msgs
+    for k in attestation_fields:
+        expected = parsed[k]
+        try:
+            v = obj[k]
+        except KeyError:
+            continue
+        if expected is None or not isinstance(v, str):
+            continue
+        if k == "month":
+            agrees = expected in v.split("/")
+        elif k in {"regnal-year", "day"}:
+            agrees = not v.isdigit() or int(v) == expected
+        else:
+            agrees = v == expected
+        if not agrees:
+            msgs.append(
+                f"Attestation '{attestation}' disagrees with value '{v}' in field '{k}' for object at sequence {i}."
+            )
+    return msgs
+
+
+def get_reign_bounds():
+    """Get precomputed (era, first year, last year) for each king ID."""
+    global reign_bounds
+    if reign_bounds is None:
+        reign_bounds = load_reign_bounds()
+    return reign_bounds
+
+
+def load_reign_bounds():
+    """Load (era, first year, last year) for each king ID from file."""
+    rpath = Path(__file__).parent.parent / "data" / "kings_reigns.json"
+    logger.debug(rpath)
+    logger.info("Loading from file: reign bounds for kings.")
+    with open(rpath, "r", encoding="utf-8") as fp:
+        raw_reigns = json.load(fp)
+    del fp
+    return {
+        king_id: (reign["era"], reign["first-year"], reign["last-year"])
+        for king_id, reign in raw_reigns.items()
+    }
+
+
+def check_reign(obj: dict, i: int):
+    """Return messages if the regnal year falls outside the king's reign."""
+    msgs = list()
+    try:
+        king = obj["king"]
+        year = obj["regnal-year"]
+    except KeyError:
+        return msgs
+    if not isinstance(king, str) or not isinstance(year, str) or not year.isdigit():
+        return msgs
+    try:
+        era, first_year, last_year = get_reign_bounds()[king]
+    except KeyError:
+        logger.debug(f"No reign bounds defined for king '{king}'.")
+        return msgs
+    if not first_year <= int(year) <= last_year:
+        msgs.append(
+            f"Regnal year '{year}' is outside the bounds {first_year}-{last_year} ({era}) for king '{king}' for object at sequence {i}."
+        )
+    return msgs
+
+
+def check_objects(objs, halt_on_error: bool, label: str = ""):
+    """
+    Yield objects one at a time after validating and checking each
+
+    Messages are prefixed with label, if given, to tell sources apart.
+    """
+    for i, obj in enumerate(objs):
+        for msg in (
+            validate_object(obj, i) + check_attestation(obj, i) + check_reign(obj, i)
+        ):
+            if label:
+                msg = f"{label}: {msg}"
+            if halt_on_error:
+                raise ValueError(msg)
+            else:
+                logger.error(msg)
+        yield obj
+
+
+def get_label_slugs(obj: dict):
+    """Get the set of label slugs used to detect possible duplicates."""
+    slugs = set()
+    for k in dedupe_fields:
+        try:
+            labels = obj[k]
+        except KeyError:
+            continue
+        if isinstance(labels, str):
+            labels = [
+                labels,
+            ]
+        slugs.update([slugify(label) for label in labels])
+    return slugs
+
+
+def log_duplicates(slug: str, matches: list):
+    """Log the objects that produced the same label slug."""
+    msg = [
+        f"POSSIBLE DUPLICATES: the following {len(matches)} rows produced the same label slug '{slug}'",
+    ]
+    for obj in matches:
+        line = [f"\tID {obj['id-in-this-doc']}"]
         for k in dedupe_fields:
             try:
                 labels = obj[k]
             except KeyError:
                 continue
-            if isinstance(labels, str):
-                labels = [
-                    labels,
-                ]
-            for label in labels:
-                slug = slugify(label)
-                try:
-                    index[slug]
-                except KeyError:
-                    index[slug] = {
-                        obj["id-in-this-doc"],
-                    }
-                else:
-                    index[slug].add(obj["id-in-this-doc"])
-            obj_lookup[obj["id-in-this-doc"]] = obj
-    concerns = {slug: matches for slug, matches in index.items() if len(matches) > 1}
-    for slug, matches in concerns.items():
-        msg = [
-            f"POSSIBLE DUPLICATES: the following {len(matches)} rows produced the same label slug '{slug}'",
-        ]
-        for match in matches:
-            obj = obj_lookup[match]
-            line = [f"\tID {obj['id-in-this-doc']}"]
-            for k in dedupe_fields:
-                try:
-                    labels = obj[k]
-                except KeyError:
-                    continue
-                else:
-                    line.append(f"{k} = {labels}")
-            msg.append(" : ".join(line))
-        msg = "\n".join(msg)
-        logger.error(msg)
+            else:
+                line.append(f"{k} = {labels}")
+        msg.append(" : ".join(line))
+    msg = "\n".join(msg)
+    logger.error(msg)
 
 
-def main(**kwargs):
+def get_dedupe_labels(obj: dict):
+    """Get only the fields of an object that are used to detect possible duplicates."""
+    return {k: obj[k] for k in dedupe_fields if k in obj}
+
+
+class SlugIndex:
     """
-    main function
+    In-memory index of label slugs, for finding possible duplicates
+
+    Objects are added one at a time and only their dedupe fields are kept.
     """
-    whence = Path(kwargs["from"]).expanduser().resolve()
-    with open(whence, "r", encoding="utf-8-sig") as fp:
-        reader = csv.DictReader(fp)
-        rows = [r for r in reader]
-    del fp
-    logger.info(f"read {len(rows)} data rows from file")
-    fieldnames = list(rows[0].keys())
-    logger.debug(f"fieldnames: {fieldnames}")
-    fn_csv2json = normalize_fieldnames(fieldnames)
-    logger.debug(
-        f"normalized fieldnames crosswalk for JSON: {pformat(fn_csv2json, indent='4')}"
-    )
-    objs = convert_rows(rows, fn_csv2json)
-    validate_objects(objs, kwargs["halt"])
-    check_duplicates(objs)
 
-    if kwargs["format"] == "json":
-        if kwargs["pretty"]:
+    def __init__(self):
+        self.postings = dict()
+        self.labels = dict()
+
+    def add(self, obj: dict, obj_id=None):
+        """Add an object's label slugs, under obj_id if given."""
+        slugs = get_label_slugs(obj)
+        if not slugs:
+            return
+        if obj_id is None:
+            obj_id = obj.get("id-in-this-doc")
+        for slug in slugs:
+            try:
+                self.postings[slug]
+            except KeyError:
+                self.postings[slug] = {
+                    obj_id,
+                }
+            else:
+                self.postings[slug].add(obj_id)
+        self.labels[obj_id] = get_dedupe_labels(obj)
+
+    def remove(self, obj_id):
+        """Remove the label slugs added under obj_id, if any."""
+        try:
+            labels = self.labels.pop(obj_id)
+        except KeyError:
+            return
+        for slug in get_label_slugs(labels):
+            self.postings[slug].discard(obj_id)
+            if not self.postings[slug]:
+                del self.postings[slug]
+
+    def merge(self, other):
+        """Add the postings and labels of another SlugIndex."""
+        for slug, obj_ids in other.postings.items():
+            try:
+                self.postings[slug].update(obj_ids)
+            except KeyError:
+                self.postings[slug] = set(obj_ids)
+        self.labels.update(other.labels)
+
+    def report(self):
+        """Log each slug produced by more than one object."""
+        for slug, obj_ids in self.postings.items():
+            if len(obj_ids) > 1:
+                matches = list()
+                for obj_id in sorted(obj_ids, key=str):
+                    obj = dict(self.labels[obj_id])
+                    obj["id-in-this-doc"] = obj_id
+                    matches.append(obj)
+                log_duplicates(slug, matches)
+
+    def close(self):
+        pass
+
+
+class DiskSlugIndex:
+    """
+    On-disk SQLite index of label slugs, for finding possible duplicates
+
+    Only slug postings and the labels of each object are stored, and only
+    the labels of colliding objects are read back for the report, so memory
+    use does not grow with the number of objects. The database is temporary
+    unless db_path is given, in which case it must not already exist and is
+    kept when the index is closed.
+    """
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            self.tmp_dir = TemporaryDirectory()
+            db_path = Path(self.tmp_dir.name) / "slugs.sqlite"
+        else:
+            self.tmp_dir = None
+        self.con = sqlite3.connect(db_path)
+        self.con.execute("CREATE TABLE postings (slug TEXT, id TEXT)")
+        self.con.execute("CREATE TABLE labels (id TEXT PRIMARY KEY, labels TEXT)")
+
+    def add(self, obj: dict, obj_id=None):
+        """Add an object's label slugs, under obj_id if given."""
+        slugs = get_label_slugs(obj)
+        if not slugs:
+            return
+        if obj_id is None:
+            obj_id = obj.get("id-in-this-doc")
+        obj_id = str(obj_id)
+        self.con.executemany(
+            "INSERT INTO postings VALUES (?, ?)",
+            [(slug, obj_id) for slug in slugs],
+        )
+        self.con.execute(
+            "INSERT OR REPLACE INTO labels VALUES (?, ?)",
+            (obj_id, json.dumps(get_dedupe_labels(obj), ensure_ascii=False)),
+        )
+
+    def merge(self, db_path):
+        """Add the postings and labels of another DiskSlugIndex database file."""
+        self.con.commit()
+        self.con.execute("ATTACH DATABASE ? AS other", (str(db_path),))
+        self.con.execute("INSERT INTO postings SELECT slug, id FROM other.postings")
+        self.con.execute(
+            "INSERT OR REPLACE INTO labels SELECT id, labels FROM other.labels"
+        )
+        self.con.commit()
+        self.con.execute("DETACH DATABASE other")
+
+    def report(self):
+        """Log each slug produced by more than one object."""
+        self.con.execute("CREATE INDEX IF NOT EXISTS postings_slug ON postings (slug)")
+        self.con.commit()
+        concerns = self.con.execute(
+            "SELECT slug FROM postings GROUP BY slug HAVING COUNT(DISTINCT id) > 1"
+        ).fetchall()
+        for (slug,) in concerns:
+            matches = list()
+            for obj_id, labels in self.con.execute(
+                "SELECT DISTINCT postings.id, labels.labels FROM postings "
+                + "JOIN labels ON labels.id = postings.id WHERE postings.slug = ? "
+                + "ORDER BY postings.id",
+                (slug,),
+            ):
+                obj = json.loads(labels)
+                obj["id-in-this-doc"] = obj_id
+                matches.append(obj)
+            log_duplicates(slug, matches)
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+        if self.tmp_dir is not None:
+            self.tmp_dir.cleanup()
+
+
+def index_objects(objs, index, id_prefix: str = ""):
+    """Yield objects unchanged, adding each to the slug index on the way."""
+    for obj in objs:
+        if id_prefix:
+            index.add(obj, f"{id_prefix}{obj.get('id-in-this-doc')}")
+        else:
+            index.add(obj)
+        yield obj
+
+
+def get_chronological_key(obj: dict):
+    """
+    Get a sort key on king-order, regnal-year, month and day
+
+    Intercalary months sort directly after the month they follow. Missing or
+    unparseable values sort after all others.
+    """
+    key = list()
+    for k in chronological_fields:
+        v = obj.get(k)
+        if k == "month" and isinstance(v, str) and v[:2].isdigit():
+            v = 2 * int(v[:2]) + int(v[2:5] == "INT")
+        elif isinstance(v, str) and v.isdigit():
+            v = int(v)
+        if isinstance(v, int) and not isinstance(v, bool):
+            key.append((0, v))
+        else:
+            key.append((1, 0))
+    return tuple(key)
+
+
+def iter_sorted_run(fp):
+    """Yield objects from a spilled run file."""
+    fp.seek(0)
+    for line in fp:
+        yield json.loads(line)
+
+
+def sort_objects(objs, key, buffer_size: int):
+    """
+    Yield objects sorted on key, using an external merge sort
+
+    Sorted runs of up to buffer_size objects are spilled to temporary files
+    and then merged, so objs may be larger than memory.
+    """
+    runs = list()
+    buf = list()
+    try:
+        for obj in objs:
+            buf.append(obj)
+            if len(buf) >= buffer_size:
+                buf.sort(key=key)
+                fp = TemporaryFile(mode="w+", encoding="utf-8")
+                for run_obj in buf:
+                    fp.write(json.dumps(run_obj, ensure_ascii=False) + "\n")
+                runs.append(fp)
+                buf = list()
+        buf.sort(key=key)
+        if not runs:
+            yield from buf
+            return
+        logger.info(f"merging {len(runs) + 1} sorted runs")
+        yield from heapq.merge(
+            *[iter_sorted_run(fp) for fp in runs], iter(buf), key=key
+        )
+    finally:
+        for fp in runs:
+            fp.close()
+
+
+@contextmanager
+def replacing(thence: Path):
+    """
+    Yield a temporary path beside thence, moved over thence only on success
+
+    If writing fails (e.g. a --halt error partway through the rows), any
+    previous file at thence is left as it was.
+    """
+    tmp_path = thence.with_name(f"{thence.name}.{os.getpid()}.tmp")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, thence)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def write_objects(objs, thence: Path, format: str, pretty: bool):
+    """
+    Write a list or iterable of objects to a single file in the desired format
+
+    Returns the number of objects written.
+    """
+    if format == "json":
+        if pretty:
             indent = 4
             sort_keys = True
+            separator = ",\n    "
         else:
             indent = None
             sort_keys = False
-        with open(kwargs["to"], "w", encoding="utf-8") as fp:
-            json.dump(objs, fp, ensure_ascii=False, indent=indent, sort_keys=sort_keys)
-        del fp
-    elif kwargs["format"] == "csv":
+            separator = ", "
+        # write one object at a time so objs may be a generator
+        count = 0
+        with replacing(thence) as tmp_path:
+            with open(tmp_path, "w", encoding="utf-8") as fp:
+                for obj in objs:
+                    if count:
+                        fp.write(separator)
+                    else:
+                        fp.write("[\n    " if pretty else "[")
+                    serialized = json.dumps(
+                        obj, ensure_ascii=False, indent=indent, sort_keys=sort_keys
+                    )
+                    if pretty:
+                        serialized = serialized.replace("\n", "\n    ")
+                    fp.write(serialized)
+                    count += 1
+                if count:
+                    fp.write("\n]" if pretty else "]")
+                else:
+                    fp.write("[]")
+            del fp
+    elif format == "jsonl":
+        offsets = dict()
+        offset = 0
+        count = 0
+        ipath = thence.with_name(thence.name + ".idx")
+        with replacing(thence) as tmp_path, replacing(ipath) as tmp_ipath:
+            with open(tmp_path, "wb") as fp:
+                for obj in objs:
+                    count += 1
+                    line = (
+                        json.dumps(obj, ensure_ascii=False, sort_keys=pretty) + "\n"
+                    ).encode("utf-8")
+                    fp.write(line)
+                    obj_id = obj.get("id-in-this-doc")
+                    if obj_id is not None:
+                        if obj_id in offsets:
+                            logger.warning(
+                                f"Duplicate id-in-this-doc '{obj_id}' in {thence}: offset index will point to the last one."
+                            )
+                        offsets[obj_id] = [offset, len(line)]
+                    offset += len(line)
+            del fp
+            with open(tmp_ipath, "w", encoding="utf-8") as fp:
+                json.dump(offsets, fp, ensure_ascii=False)
+            del fp
+    elif format == "csv":
+        # the header needs every fieldname, so spill objects while collecting them
         fieldnames = set()
-        for obj in objs:
-            fieldnames.update(list(obj.keys()))
-        with open(kwargs["to"], "w", encoding="utf-8-sig") as fp:
-            writer = csv.DictWriter(fp, fieldnames=fieldnames)
-            writer.writeheader()
+        count = 0
+        with TemporaryFile(mode="w+", encoding="utf-8") as spill:
+            for obj in objs:
+                fieldnames.update(list(obj.keys()))
+                spill.write(json.dumps(obj, ensure_ascii=False) + "\n")
+                count += 1
+            with replacing(thence) as tmp_path:
+                with open(tmp_path, "w", encoding="utf-8-sig") as fp:
+                    writer = csv.DictWriter(fp, fieldnames=fieldnames)
+                    writer.writeheader()
+                    for obj in iter_sorted_run(spill):
+                        writer.writerow(obj)
+                del fp
+    else:
+        raise ValueError(f"No support for format={format}")
+    return count
+
+
+def get_partition_value(obj: dict, key: str):
+    """Get the shard value for an object, joining multiple values."""
+    try:
+        value = obj[key]
+    except KeyError:
+        return None
+    if isinstance(value, list):
+        value = "+".join([str(v) for v in value])
+    return str(value)
+
+
+def hash_file(fpath: Path):
+    """Get the SHA-256 hex digest of a file, reading it in chunks."""
+    content_hash = hashlib.sha256()
+    with open(fpath, "rb") as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b""):
+            content_hash.update(chunk)
+    del fp
+    return content_hash.hexdigest()
+
+
+def write_partitions(objs, thence: Path, key: str, format: str, pretty: bool):
+    """
+    Write one shard per value of key into a directory, with a manifest
+
+    Objects are spilled to a temporary file per shard as they arrive, so objs
+    may be a generator larger than memory. At most MAX_OPEN_SPILLS spill files
+    are open at once, so a key with many values does not run out of file
+    descriptors. Returns the number of objects written.
+    """
+    if format not in {"json", "jsonl", "csv"}:
+        raise ValueError(f"No support for format={format}")
+    partitions = dict()
+    handles = dict()  # open spill files, least recently used first
+    with TemporaryDirectory() as tmp_dir:
+        try:
             for obj in objs:
-                writer.writerow(obj)
+                value = get_partition_value(obj, key)
+                try:
+                    spill = handles.pop(value)
+                except KeyError:
+                    try:
+                        spill_path = partitions[value]
+                    except KeyError:
+                        spill_path = Path(tmp_dir) / f"{len(partitions)}.jsonl"
+                        partitions[value] = spill_path
+                    if len(handles) >= MAX_OPEN_SPILLS:
+                        handles.pop(next(iter(handles))).close()
+                    spill = open(spill_path, "a", encoding="utf-8")
+                handles[value] = spill
+                spill.write(json.dumps(obj, ensure_ascii=False) + "\n")
+        finally:
+            for spill in handles.values():
+                spill.close()
+        thence.mkdir(parents=True, exist_ok=True)
+        shards = list()
+        shard_names = set()
+        for value, spill_path in partitions.items():
+            if value is None:
+                stem = "_none"
+            else:
+                stem = slugify(value, lowercase=False) or "_blank"
+            spath = thence / f"{stem}.{format}"
+            n = 1
+            while spath.name in shard_names:
+                n += 1
+                spath = thence / f"{stem}-{n}.{format}"
+            shard_names.add(spath.name)
+            with open(spill_path, "r", encoding="utf-8") as spill:
+                count = write_objects(iter_sorted_run(spill), spath, format, pretty)
+            del spill
+            shard = {
+                "value": value,
+                "path": spath.name,
+                "rows": count,
+                "sha256": hash_file(spath),
+            }
+            if format == "jsonl":
+                ipath = spath.with_name(spath.name + ".idx")
+                shard["index-path"] = ipath.name
+                shard["index-sha256"] = hash_file(ipath)
+            shards.append(shard)
+            logger.info(f"wrote {count} data objects to shard {spath}")
+    manifest = {
+        "partition-key": key,
+        "format": format,
+        "rows": sum([shard["rows"] for shard in shards]),
+        "shards": sorted(shards, key=lambda s: s["path"]),
+    }
+    with replacing(thence / "manifest.json") as tmp_path:
+        with open(tmp_path, "w", encoding="utf-8") as fp:
+            json.dump(manifest, fp, ensure_ascii=False, indent=4)
+        del fp
+    return manifest["rows"]
+
+
+def get_sources(source: str):
+    """Get the source CSV files named by a filename, directory or glob."""
+    spath = Path(source).expanduser()
+    if spath.is_dir():
+        return sorted([p.resolve() for p in spath.glob("*.csv")])
+    elif spath.exists():
+        return [spath.resolve()]
+    else:
+        return sorted([Path(p).resolve() for p in glob(str(spath))])
+
+
+def get_source_labels(sources: list):
+    """
+    Get a distinct label for each source, used to name its output
+
+    Labels are file stems unless two sources share a stem (e.g. from the glob
+    regions/*/combined.csv), in which case they are paths relative to the
+    sources' common directory, without the suffix.
+    """
+    stems = [whence.stem for whence in sources]
+    if len(set(stems)) == len(stems):
+        return dict(zip(sources, stems))
+    common = Path(os.path.commonpath([whence.parent for whence in sources]))
+    labels = {
+        whence: whence.relative_to(common).with_suffix("").as_posix()
+        for whence in sources
+    }
+    if len(set(labels.values())) != len(labels):
+        raise ValueError("Cannot give each source CSV file a distinct output name.")
+    return labels
+
+
+def preload():
+    """Load all converters and vocabularies so worker processes share them."""
+    data_path = Path(__file__).parent.parent / "data"
+    for cpath in (data_path / "converters").glob("*.json"):
+        get_converter(cpath.stem)
+    for vpath in (data_path / "vocabularies").glob("*.json"):
+        get_vocab(vpath.stem)
+    get_king_lookup()
+    get_reign_bounds()
+
+
+def ingest(whence: Path, thence: Path, label: str, index_path=None, **kwargs):
+    """
+    Convert, validate and write a single source CSV file
+
+    Rows are read, converted, checked, indexed for duplicates and written one
+    at a time, so the source may be larger than memory. With dedupe_across,
+    possible duplicates are not reported; instead the slug index is returned
+    (in memory) or left at index_path (on disk) for the caller to merge.
+    """
+    if kwargs["sort"] not in {"", "chronological"}:
+        raise ValueError(f"No support for sort={kwargs['sort']}")
+    start = perf_counter()
+    if kwargs["dedupe_on_disk"]:
+        index = DiskSlugIndex(index_path)
+    else:
+        index = SlugIndex()
+    if kwargs["dedupe_across"]:
+        # ids are qualified by source so the caller can merge the indexes
+        id_prefix = f"{label}:"
+    else:
+        id_prefix = ""
+    try:
+        with open(whence, "r", encoding="utf-8-sig") as fp:
+            reader = csv.DictReader(fp)
+            fieldnames = reader.fieldnames or list()
+            logger.debug(f"fieldnames: {fieldnames}")
+            fn_csv2json = normalize_fieldnames(fieldnames)
+            logger.debug(
+                f"normalized fieldnames crosswalk for JSON: {pformat(fn_csv2json, indent='4')}"
+            )
+            objs = iter_converted_rows(reader, fn_csv2json)
+            objs = check_objects(objs, kwargs["halt"], label)
+            objs = index_objects(objs, index, id_prefix)
+            if kwargs["sort"] == "chronological":
+                objs = sort_objects(objs, get_chronological_key, kwargs["sort_buffer"])
+            if kwargs["partition"]:
+                count = write_partitions(
+                    objs,
+                    thence,
+                    kwargs["partition"],
+                    kwargs["format"],
+                    kwargs["pretty"],
+                )
+            else:
+                count = write_objects(objs, thence, kwargs["format"], kwargs["pretty"])
         del fp
+        logger.info(f"wrote {count} data objects to {thence}")
+        if not kwargs["dedupe_across"]:
+            index.report()
+    finally:
+        index.close()
+    if kwargs["dedupe_across"] and not kwargs["dedupe_on_disk"]:
+        return (count, perf_counter() - start, index)
+    return (count, perf_counter() - start, None)
+
+
+def main(**kwargs):
+    """
+    main function
+    """
+    sources = get_sources(kwargs["from"])
+    if not sources:
+        raise ValueError(f"No source CSV files found for '{kwargs['from']}'.")
+    thence = Path(kwargs["to"]).expanduser().resolve()
+    if Path(kwargs["from"]).expanduser().is_file():
+        # a single source: checking across sources is checking within it
+        kwargs["dedupe_across"] = False
+        ingest(sources[0], thence, sources[0].stem, **kwargs)
+        return
+
+    thence.mkdir(parents=True, exist_ok=True)
+    preload()
+    jobs = kwargs["jobs"] or None
+    start = perf_counter()
+    total = 0
+    if kwargs["dedupe_on_disk"]:
+        index = DiskSlugIndex()
     else:
-        raise ValueError(f"No support for format={kwargs['format']}")
-    logger.info(f"wrote {len(objs)} data objects to stdout")
+        index = SlugIndex()
+    try:
+        with TemporaryDirectory() as tmp_dir:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=preload) as executor:
+                futures = dict()
+                labels = get_source_labels(sources)
+                for i, whence in enumerate(sources):
+                    label = labels[whence]
+                    if kwargs["partition"]:
+                        destination = thence / label
+                    else:
+                        destination = thence / f"{label}.{kwargs['format']}"
+                    destination.parent.mkdir(parents=True, exist_ok=True)
+                    if kwargs["dedupe_across"] and kwargs["dedupe_on_disk"]:
+                        index_path = Path(tmp_dir) / f"{i}.sqlite"
+                    else:
+                        index_path = None
+                    future = executor.submit(
+                        ingest, whence, destination, label, index_path, **kwargs
+                    )
+                    futures[whence] = (future, index_path)
+                for whence, (future, index_path) in futures.items():
+                    count, elapsed, source_index = future.result()
+                    total += count
+                    if source_index is not None:
+                        index.merge(source_index)
+                    elif index_path is not None:
+                        index.merge(index_path)
+                    print(
+                        f"{labels[whence]}: {count} rows in {elapsed:.2f}s ({count / elapsed:.0f} rows/s)"
+                    )
+        if kwargs["dedupe_across"]:
+            index.report()
+    finally:
+        index.close()
+    elapsed = perf_counter() - start
+    print(
+        f"TOTAL: {len(sources)} files, {total} rows in {elapsed:.2f}s ({total / elapsed:.0f} rows/s)"
+    )
 
 
 if __name__ == "__main__":
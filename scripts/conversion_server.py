@@ -0,0 +1,280 @@
+#
+# This file is part of nabonassar
+# by Tom Elliott for the Institute for the Study of the Ancient World
+# (c) Copyright 2022 by New York University
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+"""
+Serve row normalization, conversion, validation and duplicate checks over HTTP
+"""
+
+from airtight.cli import configure_commandline
+import combined2json
+from combined2json import (
+    build_king_lookup,
+    check_attestation,
+    dedupe_fields,
+    check_reign,
+    convert_rows,
+    get_label_slugs,
+    integer_fields,
+    load_reign_bounds,
+    normalize_fieldnames,
+    SlugIndex,
+    validate_object,
+)
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+from pathlib import Path
+from records import iter_records
+import threading
+
+logger = logging.getLogger(__name__)
+data_path = Path(__file__).parent.parent / "data"
+data_lock = threading.Lock()
+data_mtimes = dict()
+failed_mtimes = dict()
+slug_index = SlugIndex()
+
+DEFAULT_LOG_LEVEL = logging.WARNING
+OPTIONAL_ARGUMENTS = [
+    [
+        "-l",
+        "--loglevel",
+        "NOTSET",
+        "desired logging level ("
+        + "case-insensitive string: DEBUG, INFO, WARNING, or ERROR",
+        False,
+    ],
+    ["-v", "--verbose", False, "verbose output (logging level == INFO)", False],
+    [
+        "-w",
+        "--veryverbose",
+        False,
+        "very verbose output (logging level == DEBUG)",
+        False,
+    ],
+    ["-a", "--address", "127.0.0.1", "address on which to listen", False],
+    ["-p", "--port", 8000, "port on which to listen", False],
+    [
+        "-i",
+        "--index",
+        "",
+        "cleaned JSON file with which to seed the duplicate slug index",
+        False,
+    ],
+]
+POSITIONAL_ARGUMENTS = [
+    # each row is a list with 3 elements: name, type, help
+]
+
+
+def get_data_mtimes():
+    """Get modification times of all converter and vocabulary files."""
+    mtimes = dict()
+    for subdir in ["converters", "vocabularies"]:
+        for fpath in (data_path / subdir).glob("*"):
+            mtimes[fpath] = fpath.stat().st_mtime_ns
+    fpath = data_path / "kings_reigns.json"
+    mtimes[fpath] = fpath.stat().st_mtime_ns
+    return mtimes
+
+
+def load_data():
+    """Load all converters and vocabularies from file."""
+    converters = dict()
+    for cpath in (data_path / "converters").glob("*.json"):
+        with open(cpath, "r", encoding="utf-8") as fp:
+            raw_converter = json.load(fp)
+        del fp
+        if isinstance(raw_converter, dict):
+            converters[cpath.stem] = raw_converter
+        else:
+            raise RuntimeError("phooey")
+    vocabularies = dict()
+    for vpath in (data_path / "vocabularies").glob("*.json"):
+        with open(vpath, "r", encoding="utf-8") as fp:
+            raw_vocab = json.load(fp)
+        del fp
+        if isinstance(raw_vocab, dict):
+            vocabularies[vpath.stem] = raw_vocab
+        else:
+            vocabularies[vpath.stem] = {v: True for v in raw_vocab}
+    return (converters, vocabularies)
+
+
+def refresh_data():
+    """Reload converters and vocabularies if their files have changed."""
+    global data_mtimes
+    global failed_mtimes
+    mtimes = get_data_mtimes()
+    if mtimes == data_mtimes or mtimes == failed_mtimes:
+        return
+    try:
+        converters, vocabularies = load_data()
+        king_lookup = build_king_lookup(converters.get("king"))
+        reign_bounds = load_reign_bounds()
+    except (KeyError, OSError, RuntimeError, ValueError) as err:
+        # e.g. a file caught half-saved: keep serving the previous data
+        logger.error(f"Failed to reload converters, vocabularies and reigns: {err}")
+        failed_mtimes = mtimes
+        return
+    with data_lock:
+        combined2json.converters = converters
+        combined2json.vocabularies = vocabularies
+        combined2json.king_lookup = king_lookup
+        combined2json.reign_bounds = reign_bounds
+        data_mtimes = mtimes
+    logger.info(
+        f"Loaded {len(converters)} converters and {len(vocabularies)} vocabularies."
+    )
+
+
+def index_object(obj: dict):
+    """Add an object to the slug index, replacing any previous entry for its id."""
+    slug_index.remove(obj["id-in-this-doc"])
+    slug_index.add(obj)
+
+
+def clean_row(row: dict):
+    """Coerce cell values to strings, as read from CSV."""
+    return {k: "" if v is None else str(v) for k, v in row.items()}
+
+
+def convert_row(row: dict):
+    """Convert a single row with raw or normalized fieldnames to an object."""
+    row = clean_row(row)
+    return convert_rows([row], normalize_fieldnames(list(row.keys())))[0]
+
+
+def convert_row_with_errors(row: dict):
+    """Convert the cells of a row that can be converted, reporting the others."""
+    row = clean_row(row)
+    fn_crosswalk = normalize_fieldnames(list(row.keys()))
+    good_row = dict()
+    errors = list()
+    for k, v in row.items():
+        try:
+            converted = convert_rows([{k: v}], fn_crosswalk)[0]
+        except ValueError as err:
+            errors.append(str(err))
+            continue
+        clean_v = " ".join(v.strip().split())
+        if fn_crosswalk[k] in integer_fields and clean_v and not converted:
+            # convert_rows only logs these and drops the value
+            errors.append(f"Unexpected non-integer value for field '{k}': '{clean_v}'")
+        else:
+            good_row[k] = v
+    return (convert_rows([good_row], fn_crosswalk)[0], errors)
+
+
+def get_object(payload: dict):
+    try:
+        return payload["object"]
+    except KeyError:
+        return convert_row(payload["row"])
+
+
+def do_normalize(payload: dict):
+    return {"crosswalk": normalize_fieldnames(payload["fieldnames"])}
+
+
+def do_convert_row(payload: dict):
+    return {"object": convert_row(payload["row"])}
+
+
+def do_validate_row(payload: dict):
+    try:
+        obj = payload["object"]
+    except KeyError:
+        obj, errors = convert_row_with_errors(payload["row"])
+    else:
+        errors = list()
+    errors += validate_object(obj, 0) + check_attestation(obj, 0) + check_reign(obj, 0)
+    return {"object": obj, "errors": errors}
+
+
+def do_check_duplicate(payload: dict):
+    obj = get_object(payload)
+    obj_id = obj["id-in-this-doc"]
+    duplicates = dict()
+    for slug in get_label_slugs(obj):
+        matches = slug_index.postings.get(slug, set()) - {obj_id}
+        if matches:
+            duplicates[slug] = sorted(matches)
+    if payload.get("add", True):
+        index_object(obj)
+    return {"object": obj, "duplicates": duplicates}
+
+
+endpoints = {
+    "/normalize": do_normalize,
+    "/convert-row": do_convert_row,
+    "/validate-row": do_validate_row,
+    "/check-duplicate": do_check_duplicate,
+}
+
+
+class ConversionRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            endpoint = endpoints[self.path]
+        except KeyError:
+            self.send_json(404, {"error": f"No endpoint '{self.path}'."})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length))
+            refresh_data()
+            with data_lock:
+                response = endpoint(payload)
+        except (KeyError, TypeError, ValueError) as err:
+            self.send_json(400, {"error": f"{type(err).__name__}: {err}"})
+        except Exception as err:
+            logger.exception(f"Unexpected error handling {self.path}")
+            self.send_json(500, {"error": f"{type(err).__name__}: {err}"})
+        else:
+            self.send_json(200, response)
+
+    def send_json(self, status: int, response: dict):
+        body = json.dumps(response, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.info(format % args)
+
+
+def main(**kwargs):
+    """
+    main function
+    """
+    refresh_data()
+    if kwargs["index"]:
+        whence = Path(kwargs["index"]).expanduser().resolve()
+        count = 0
+        for obj in iter_records(whence, ["id-in-this-doc"] + list(dedupe_fields)):
+            index_object(obj)
+            count += 1
+        logger.info(f"Indexed {count} objects from {whence}")
+    server = ThreadingHTTPServer(
+        (kwargs["address"], int(kwargs["port"])), ConversionRequestHandler
+    )
+    print(f"Serving on http://{kwargs['address']}:{kwargs['port']}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main(
+        **configure_commandline(
+            OPTIONAL_ARGUMENTS, POSITIONAL_ARGUMENTS, DEFAULT_LOG_LEVEL
+        )
+    )
@@ -0,0 +1,177 @@
+#
+# This file is part of nabonassar
+# by Tom Elliott for the Institute for the Study of the Ancient World
+# (c) Copyright 2022 by New York University
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+"""
+Report added, removed and changed documents between two cleaned releases
+"""
+
+from airtight.cli import configure_commandline
+import hashlib
+import json
+import logging
+from pathlib import Path
+from records import iter_records
+import sqlite3
+from tempfile import TemporaryDirectory
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOG_LEVEL = logging.WARNING
+OPTIONAL_ARGUMENTS = [
+    [
+        "-l",
+        "--loglevel",
+        "NOTSET",
+        "desired logging level ("
+        + "case-insensitive string: DEBUG, INFO, WARNING, or ERROR",
+        False,
+    ],
+    ["-v", "--verbose", False, "verbose output (logging level == INFO)", False],
+    [
+        "-w",
+        "--veryverbose",
+        False,
+        "very verbose output (logging level == DEBUG)",
+        False,
+    ],
+]
+POSITIONAL_ARGUMENTS = [
+    # each row is a list with 3 elements: name, type, help
+    ["old", str, "earlier cleaned release (JSON or JSON Lines)"],
+    ["new", str, "later cleaned release (JSON or JSON Lines)"],
+]
+
+
+def hash_record(obj: dict):
+    """Hash the canonical JSON serialization of a record."""
+    canonical = json.dumps(
+        obj, ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha1(canonical.encode("utf-8")).digest()
+
+
+def index_release(path: str):
+    """Get a list of (id, content hash) pairs sorted by id."""
+    index = dict()
+    for obj in iter_records(path):
+        try:
+            obj_id = obj["id-in-this-doc"]
+        except KeyError:
+            logger.warning(f"Skipping record with no id-in-this-doc in {path}")
+            continue
+        if obj_id in index:
+            logger.warning(f"Duplicate id-in-this-doc '{obj_id}' in {path}")
+        index[obj_id] = hash_record(obj)
+    logger.info(f"Indexed {len(index)} records in {path}")
+    return sorted(index.items())
+
+
+def merge_indexes(old_index: list, new_index: list):
+    """Sorted merge of two release indexes into added, removed and changed ids."""
+    added = list()
+    removed = list()
+    changed = list()
+    i = j = 0
+    while i < len(old_index) and j < len(new_index):
+        old_id, old_hash = old_index[i]
+        new_id, new_hash = new_index[j]
+        if old_id == new_id:
+            if old_hash != new_hash:
+                changed.append(old_id)
+            i += 1
+            j += 1
+        elif old_id < new_id:
+            removed.append(old_id)
+            i += 1
+        else:
+            added.append(new_id)
+            j += 1
+    removed.extend([obj_id for obj_id, h in old_index[i:]])
+    added.extend([obj_id for obj_id, h in new_index[j:]])
+    return (added, removed, changed)
+
+
+def diff_fields(old_obj: dict, new_obj: dict):
+    """
+    Get old and new values for each field that differs
+
+    A field absent from one record has no "old" or "new" key, so it can be
+    told apart from an explicit null.
+    """
+    differences = dict()
+    for k in sorted(set(old_obj) | set(new_obj)):
+        difference = dict()
+        if k in old_obj:
+            difference["old"] = old_obj[k]
+        if k in new_obj:
+            difference["new"] = new_obj[k]
+        if k not in old_obj or k not in new_obj or old_obj[k] != new_obj[k]:
+            differences[k] = difference
+    return differences
+
+
+def spill_records(path: str, wanted: set, db_path: Path):
+    """Store the records with wanted ids in an SQLite file, keyed by id."""
+    con = sqlite3.connect(db_path)
+    try:
+        con.execute("CREATE TABLE records (id TEXT PRIMARY KEY, record TEXT)")
+        for obj in iter_records(path):
+            obj_id = obj.get("id-in-this-doc")
+            if obj_id in wanted:
+                con.execute(
+                    "INSERT OR REPLACE INTO records VALUES (?, ?)",
+                    (json.dumps(obj_id), json.dumps(obj, ensure_ascii=False)),
+                )
+        con.commit()
+    finally:
+        con.close()
+
+
+def main(**kwargs):
+    """
+    main function
+    """
+    old_index = index_release(kwargs["old"])
+    new_index = index_release(kwargs["new"])
+    added, removed, changed = merge_indexes(old_index, new_index)
+    del old_index
+    del new_index
+    logger.info(
+        f"{len(added)} added, {len(removed)} removed, {len(changed)} changed records"
+    )
+    wanted = set(changed)
+    differences = dict()
+    # changed records may be most of the old release, so keep them on disk
+    with TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / "old.sqlite"
+        spill_records(kwargs["old"], wanted, db_path)
+        con = sqlite3.connect(db_path)
+        try:
+            for obj in iter_records(kwargs["new"]):
+                obj_id = obj.get("id-in-this-doc")
+                if obj_id not in wanted or obj_id in differences:
+                    continue
+                row = con.execute(
+                    "SELECT record FROM records WHERE id = ?", (json.dumps(obj_id),)
+                ).fetchone()
+                if row is not None:
+                    differences[obj_id] = diff_fields(json.loads(row[0]), obj)
+        finally:
+            con.close()
+    report = {
+        "added": added,
+        "removed": removed,
+        "changed": {obj_id: differences[obj_id] for obj_id in changed},
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=4, sort_keys=False))
+
+
+if __name__ == "__main__":
+    main(
+        **configure_commandline(
+            OPTIONAL_ARGUMENTS, POSITIONAL_ARGUMENTS, DEFAULT_LOG_LEVEL
+        )
+    )
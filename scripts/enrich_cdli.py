@@ -0,0 +1,268 @@
+#
+# This file is part of nabonassar
+# by Tom Elliott for the Institute for the Study of the Ancient World
+# (c) Copyright 2022 by New York University
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+"""
+Enrich cleaned records with CDLI tablet metadata keyed by their uri field
+"""
+
+from airtight.cli import configure_commandline
+from combined2json import write_objects
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+from pathlib import Path
+from records import iter_records
+import re
+from time import time
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+logger = logging.getLogger(__name__)
+rx_cdli_uri = re.compile(r"^http://cdli.ucla.edu/(P\d+)$")
+
+DEFAULT_LOG_LEVEL = logging.WARNING
+OPTIONAL_ARGUMENTS = [
+    [
+        "-l",
+        "--loglevel",
+        "NOTSET",
+        "desired logging level ("
+        + "case-insensitive string: DEBUG, INFO, WARNING, or ERROR",
+        False,
+    ],
+    ["-v", "--verbose", False, "verbose output (logging level == INFO)", False],
+    [
+        "-w",
+        "--veryverbose",
+        False,
+        "very verbose output (logging level == DEBUG)",
+        False,
+    ],
+    [
+        "-p",
+        "--pretty",
+        False,
+        "pretty-print the output JSON for easy readability",
+        False,
+    ],
+    ["-f", "--format", "json", "output format (json or jsonl)", False],
+    [
+        "-c",
+        "--cache",
+        "~/.cache/nabonassar/cdli",
+        "directory in which to cache fetched metadata",
+        False,
+    ],
+    [
+        "-o",
+        "--offline",
+        "",
+        "directory of <P-number>.json files to use instead of the network",
+        False,
+    ],
+    [
+        "-u",
+        "--url-template",
+        "https://cdli.mpiwg-berlin.mpg.de/artifacts/{number}.json",
+        "URL template for fetching metadata ({p_number} and {number} are replaced)",
+        False,
+    ],
+    ["-j", "--jobs", 4, "maximum number of concurrent fetches", False],
+    [
+        "-r",
+        "--refresh",
+        False,
+        "fetch every P-number again instead of using cached metadata",
+        False,
+    ],
+    [
+        "-t",
+        "--negative-ttl",
+        30.0,
+        "days after which a cached 'not found' is looked up again",
+        False,
+    ],
+]
+POSITIONAL_ARGUMENTS = [
+    # each row is a list with 3 elements: name, type, help
+    ["from", str, "json source file"],
+    ["to", str, "destination filename"],
+]
+
+
+def get_p_number(obj: dict):
+    """Get the CDLI P-number from an object's uri, if any."""
+    uri = obj.get("uri")
+    if not isinstance(uri, str):
+        return None
+    match = rx_cdli_uri.match(uri)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def make_http_fetcher(url_template: str, timeout: float = 30.0):
+    """Make a fetcher that gets metadata for a P-number over HTTP."""
+
+    def fetch(p_number: str):
+        url = url_template.format(p_number=p_number, number=int(p_number[1:]))
+        logger.debug(f"Fetching {url}")
+        request = Request(url, headers={"Accept": "application/json"})
+        try:
+            with urlopen(request, timeout=timeout) as response:
+                return json.load(response)
+        except HTTPError as err:
+            if err.code == 404:
+                return None
+            raise
+
+    return fetch
+
+
+def make_file_fetcher(directory: Path):
+    """Make a fetcher that reads metadata for a P-number from a local file."""
+
+    def fetch(p_number: str):
+        try:
+            fp = open(directory / f"{p_number}.json", "r", encoding="utf-8")
+        except FileNotFoundError:
+            return None
+        with fp:
+            return json.load(fp)
+
+    return fetch
+
+
+def cache_get(cache_dir: Path, p_number: str, negative_ttl: float):
+    """
+    Get cached metadata; raises KeyError if the P-number is not cached
+
+    A cached "not found" (None) older than negative_ttl days counts as not
+    cached, so the P-number is looked up again.
+    """
+    cpath = cache_dir / f"{p_number}.json"
+    try:
+        fp = open(cpath, "r", encoding="utf-8")
+    except FileNotFoundError:
+        raise KeyError(p_number)
+    with fp:
+        metadata = json.load(fp)
+    if metadata is None and time() - cpath.stat().st_mtime > negative_ttl * 86400:
+        raise KeyError(p_number)
+    return metadata
+
+
+def cache_put(cache_dir: Path, p_number: str, metadata):
+    """Cache metadata (None for a P-number the source does not know)."""
+    cpath = cache_dir / f"{p_number}.json"
+    tmp_path = cpath.with_name(f"{cpath.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as fp:
+        json.dump(metadata, fp, ensure_ascii=False)
+    del fp
+    os.replace(tmp_path, cpath)
+
+
+def resolve_p_numbers(
+    p_numbers,
+    fetcher,
+    cache_dir: Path,
+    max_workers: int,
+    write_cache: bool = True,
+    refresh: bool = False,
+    negative_ttl: float = 30.0,
+):
+    """
+    Get metadata for each distinct P-number, from the cache or the fetcher
+
+    Repeated P-numbers are fetched once, and at most max_workers fetches
+    run at a time. Successful fetches are cached if write_cache; "not found"
+    results are cached too, but expire after negative_ttl days. With refresh,
+    every P-number is fetched again.
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    metadata = dict()
+    misses = list()
+    for p_number in dict.fromkeys(p_numbers):
+        if refresh:
+            misses.append(p_number)
+            continue
+        try:
+            metadata[p_number] = cache_get(cache_dir, p_number, negative_ttl)
+        except KeyError:
+            misses.append(p_number)
+    logger.info(f"{len(metadata)} P-numbers cached, {len(misses)} to fetch")
+
+    def fetch_and_cache(p_number: str):
+        try:
+            result = fetcher(p_number)
+        except (HTTPError, URLError, OSError, ValueError) as err:
+            logger.warning(f"Failed to fetch metadata for {p_number}: {err}")
+            return None
+        if write_cache:
+            cache_put(cache_dir, p_number, result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for p_number, result in zip(misses, executor.map(fetch_and_cache, misses)):
+            metadata[p_number] = result
+    return metadata
+
+
+def enrich(objs, metadata: dict):
+    """Yield objects with CDLI metadata added under the cdli field."""
+    for obj in objs:
+        try:
+            obj["cdli"] = metadata[get_p_number(obj)]
+        except KeyError:
+            pass
+        else:
+            if obj["cdli"] is None:
+                del obj["cdli"]
+        yield obj
+
+
+def main(**kwargs):
+    """
+    main function
+    """
+    whence = Path(kwargs["from"]).expanduser().resolve()
+    thence = Path(kwargs["to"]).expanduser().resolve()
+    if kwargs["format"] not in {"json", "jsonl"}:
+        raise ValueError(f"No support for format={kwargs['format']}")
+    if kwargs["offline"]:
+        fetcher = make_file_fetcher(Path(kwargs["offline"]).expanduser().resolve())
+    else:
+        fetcher = make_http_fetcher(kwargs["url_template"])
+    p_numbers = {get_p_number(obj) for obj in iter_records(whence, ["uri"])}
+    p_numbers.discard(None)
+    # local files are not authoritative, so don't let them into the shared cache
+    metadata = resolve_p_numbers(
+        sorted(p_numbers),
+        fetcher,
+        Path(kwargs["cache"]).expanduser().resolve(),
+        kwargs["jobs"],
+        write_cache=not kwargs["offline"],
+        refresh=kwargs["refresh"],
+        negative_ttl=kwargs["negative_ttl"],
+    )
+    del p_numbers
+    found = len([m for m in metadata.values() if m is not None])
+    logger.info(f"Found metadata for {found} of {len(metadata)} P-numbers")
+    write_objects(
+        enrich(iter_records(whence), metadata),
+        thence,
+        kwargs["format"],
+        kwargs["pretty"],
+    )
+
+
+if __name__ == "__main__":
+    main(
+        **configure_commandline(
+            OPTIONAL_ARGUMENTS, POSITIONAL_ARGUMENTS, DEFAULT_LOG_LEVEL
+        )
+    )
@@ -13,6 +13,7 @@ import json
 import logging
 from pathlib import Path
 from pprint import pprint
+from records import iter_records
 from wikidataintegrator import wdi_core
 
 
@@ -49,11 +50,8 @@ def main(**kwargs):
     """
     # logger = logging.getLogger(sys._getframe().f_code.co_name)
     whence = Path(kwargs["from"]).expanduser().resolve()
-    with open(whence, "r", encoding="utf-8") as fp:
-        raw_data = json.load(fp)
-    del fp
     raw_kings = set()
-    for datum in raw_data:
+    for datum in iter_records(whence, ["king"]):
         try:
             king_id = datum["king"]
         except KeyError:
@@ -0,0 +1,285 @@
+#
+# This file is part of nabonassar
+# by Tom Elliott for the Institute for the Study of the Ancient World
+# (c) Copyright 2022 by New York University
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+"""
+Score month lengths and last days of month against computed lunations
+"""
+
+from airtight.cli import configure_commandline
+import json
+import logging
+import numpy as np
+from pathlib import Path
+from records import iter_records
+import re
+
+logger = logging.getLogger(__name__)
+SYNODIC_MONTH = 29.530588861
+BABYLON_LONGITUDE = 44.42  # degrees east
+VISIBILITY_AGE = 1.0  # minimum age in days of the moon at sunset for first crescent
+NISANNU_OFFSET = -12.0  # days from the vernal equinox before which Nisannu cannot begin
+rx_month = re.compile(r"^(\d\d)(INT)?$")
+projection = [
+    "id-in-this-doc",
+    "king",
+    "regnal-year",
+    "month",
+    "day",
+    "is-last-day-of-month",
+]
+
+DEFAULT_LOG_LEVEL = logging.WARNING
+OPTIONAL_ARGUMENTS = [
+    [
+        "-l",
+        "--loglevel",
+        "NOTSET",
+        "desired logging level ("
+        + "case-insensitive string: DEBUG, INFO, WARNING, or ERROR",
+        False,
+    ],
+    ["-v", "--verbose", False, "verbose output (logging level == INFO)", False],
+    [
+        "-w",
+        "--veryverbose",
+        False,
+        "very verbose output (logging level == DEBUG)",
+        False,
+    ],
+    [
+        "-a",
+        "--all",
+        False,
+        "output every dated record, not only those that can be scored",
+        False,
+    ],
+]
+POSITIONAL_ARGUMENTS = [
+    # each row is a list with 3 elements: name, type, help
+    ["from", str, "json source file"]
+]
+
+
+def delta_t(year):
+    """Estimate TT - UT in days (Morrison and Stephenson parabola)."""
+    u = (year - 1820.0) / 100.0
+    return (-20.0 + 32.0 * u**2) / 86400.0
+
+
+def march_equinox(year):
+    """Get the Julian Day (TT) of the March equinox for astronomical years."""
+    y = year / 1000.0
+    return (
+        1721139.29189
+        + 365242.13740 * y
+        + 0.06134 * y**2
+        + 0.00111 * y**3
+        - 0.00071 * y**4
+    )
+
+
+def mean_new_moon(k):
+    """Get the Julian Day (TT) of mean new moons for lunation numbers k."""
+    t = k / 1236.85
+    return (
+        2451550.09766
+        + SYNODIC_MONTH * k
+        + 0.00015437 * t**2
+        - 0.000000150 * t**3
+        + 0.00000000073 * t**4
+    )
+
+
+def true_new_moon(k):
+    """Get the Julian Day (UT) of true new moons for lunation numbers k."""
+    t = k / 1236.85
+    e = 1.0 - 0.002516 * t - 0.0000074 * t**2
+    m = np.radians(2.5534 + 29.10535670 * k - 0.0000014 * t**2 - 0.00000011 * t**3)
+    mp = np.radians(
+        201.5643
+        + 385.81693528 * k
+        + 0.0107582 * t**2
+        + 0.00001238 * t**3
+        - 0.000000058 * t**4
+    )
+    f = np.radians(
+        160.7108
+        + 390.67050284 * k
+        - 0.0016118 * t**2
+        - 0.00000227 * t**3
+        + 0.000000011 * t**4
+    )
+    omega = np.radians(124.7746 - 1.56375588 * k + 0.0020672 * t**2)
+    correction = (
+        -0.40720 * np.sin(mp)
+        + 0.17241 * e * np.sin(m)
+        + 0.01608 * np.sin(2 * mp)
+        + 0.01039 * np.sin(2 * f)
+        + 0.00739 * e * np.sin(mp - m)
+        - 0.00514 * e * np.sin(mp + m)
+        + 0.00208 * e**2 * np.sin(2 * m)
+        - 0.00111 * np.sin(mp - 2 * f)
+        - 0.00057 * np.sin(mp + 2 * f)
+        + 0.00056 * e * np.sin(2 * mp + m)
+        - 0.00042 * np.sin(3 * mp)
+        + 0.00042 * e * np.sin(m + 2 * f)
+        + 0.00038 * e * np.sin(m - 2 * f)
+        - 0.00024 * e * np.sin(2 * mp - m)
+        - 0.00017 * np.sin(omega)
+    )
+    jde = mean_new_moon(k) + correction
+    return jde - delta_t(2000.0 + k / 12.3685)
+
+
+def month_start(k):
+    """
+    Get the local Julian Day of the sunset beginning the month after new moon k
+
+    The Babylonian day begins at sunset (taken as 18:00 local mean time) and
+    the month on the first evening the crescent is old enough to be seen.
+    """
+    local = true_new_moon(k) + BABYLON_LONGITUDE / 360.0
+    return np.ceil(local + VISIBILITY_AGE - 0.25) + 0.25
+
+
+def nisannu_lunation(julian_year):
+    """Get the lunation number of new moon preceding Nisannu for astronomical years."""
+    earliest = march_equinox(julian_year) + NISANNU_OFFSET
+    k0 = np.floor((earliest - 2451550.09766) / SYNODIC_MONTH) - 1
+    candidates = k0[:, np.newaxis] + np.arange(3)
+    starts = month_start(candidates)
+    return k0 + np.argmax(starts >= earliest[:, np.newaxis], axis=1)
+
+
+def score_lunations(julian_years, months, days, last_days):
+    """
+    Score claimed days of month against computed month lengths
+
+    Arguments are equal-length arrays: astronomical year in which the
+    Babylonian year began, month slot in the year (0 for Nisannu, 12 for an
+    intercalary Addaru), day of month and whether the record claims the day
+    is the last of its month. Returns Julian Day Numbers of the dates,
+    computed month lengths and scores (1.0 consistent, 0.0 inconsistent,
+    NaN when the record makes no claim that can be checked).
+    """
+    k = nisannu_lunation(julian_years) + months
+    starts = month_start(k)
+    lengths = (month_start(k + 1) - starts).astype(int)
+    jdns = (starts + 0.75).astype(int) + days - 1
+    scores = np.full(len(k), np.nan)
+    scores[last_days] = (days == lengths)[last_days]
+    too_long = ~last_days & (days > lengths)
+    scores[too_long] = 0.0
+    return (jdns, lengths, scores)
+
+
+def parse_month(month: str):
+    """
+    Get the month number and whether it is intercalary
+
+    Returns None for values such as 06INT/12INT that do not name one month.
+    """
+    match = rx_month.match(month)
+    if match is None:
+        return None
+    return (int(match.group(1)), match.group(2) is not None)
+
+
+def get_month_slots(julian_years, numbers, intercalary):
+    """
+    Get the position of each month within its year
+
+    A year in which any record is dated to VI2 is taken to have an
+    intercalary Ululu, so VI2 is its seventh month and VII to XII are its
+    eighth to thirteenth. XII2 is the thirteenth month of other years.
+    """
+    ululu_years = np.unique(julian_years[intercalary & (numbers == 6)])
+    shifted = (numbers >= 7) & np.isin(julian_years, ululu_years)
+    return numbers - 1 + intercalary.astype(int) + shifted.astype(int)
+
+
+def main(**kwargs):
+    """
+    main function
+    """
+    rpath = Path(__file__).parent.parent / "data" / "kings_reigns.json"
+    with open(rpath, "r", encoding="utf-8") as fp:
+        reigns = json.load(fp)
+    del fp
+    epochs = {king_id: reign["julian-year-1"] for king_id, reign in reigns.items()}
+    whence = Path(kwargs["from"]).expanduser().resolve()
+    ids = list()
+    julian_years = list()
+    numbers = list()
+    intercalary = list()
+    days = list()
+    last_days = list()
+    ambiguous = 0
+    for obj in iter_records(whence, projection):
+        try:
+            epoch = epochs[obj["king"]]
+            year = obj["regnal-year"]
+            month = obj["month"]
+            day = obj["day"]
+        except (KeyError, TypeError):
+            continue
+        if not (
+            isinstance(year, str)
+            and year.isdigit()
+            and isinstance(month, str)
+            and month[:2].isdigit()
+            and isinstance(day, str)
+            and day.isdigit()
+        ):
+            continue
+        parsed_month = parse_month(month)
+        if parsed_month is None:
+            ambiguous += 1
+            continue
+        ids.append(obj["id-in-this-doc"])
+        julian_years.append(epoch + int(year) - 1)
+        numbers.append(parsed_month[0])
+        intercalary.append(parsed_month[1])
+        days.append(int(day))
+        last_days.append(obj.get("is-last-day-of-month") is True)
+    logger.info(f"Read {len(ids)} dated records from file")
+    if ambiguous:
+        logger.warning(f"Skipped {ambiguous} records with an ambiguous month")
+    if not ids:
+        print(json.dumps(dict()))
+        return
+    julian_years = np.array(julian_years, dtype=float)
+    months = get_month_slots(
+        julian_years, np.array(numbers), np.array(intercalary, dtype=bool)
+    )
+    jdns, lengths, scores = score_lunations(
+        julian_years,
+        months,
+        np.array(days),
+        np.array(last_days, dtype=bool),
+    )
+    results = dict()
+    for i, obj_id in enumerate(ids):
+        if np.isnan(scores[i]) and not kwargs["all"]:
+            continue
+        results[obj_id] = {
+            "julian-day-number": int(jdns[i]),
+            "computed-month-length": int(lengths[i]),
+            "consistent": None if np.isnan(scores[i]) else bool(scores[i]),
+        }
+    scored = scores[~np.isnan(scores)]
+    logger.info(
+        f"Scored {len(scored)} records: {int(scored.sum())} consistent, {len(scored) - int(scored.sum())} inconsistent"
+    )
+    print(json.dumps(results, ensure_ascii=False, indent=4, sort_keys=False))
+
+
+if __name__ == "__main__":
+    main(
+        **configure_commandline(
+            OPTIONAL_ARGUMENTS, POSITIONAL_ARGUMENTS, DEFAULT_LOG_LEVEL
+        )
+    )
@@ -0,0 +1,117 @@
+#
+# This file is part of nabonassar
+# by Tom Elliott for the Institute for the Study of the Ancient World
+# (c) Copyright 2022 by New York University
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+"""
+Read cleaned records without loading the whole dataset
+"""
+
+import json
+import logging
+import mmap
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+CHUNK_SIZE = 1 << 16
+
+
+def iter_json_records(path):
+    """
+    Yield records one at a time from a cleaned JSON array or JSON Lines file
+    """
+    decoder = json.JSONDecoder()
+    with open(Path(path).expanduser().resolve(), "r", encoding="utf-8") as fp:
+        buf = fp.read(CHUNK_SIZE).lstrip()
+        if not buf.startswith("["):
+            fp.seek(0)
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        pos = 1
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                chunk = fp.read(CHUNK_SIZE)
+                if not chunk:
+                    raise
+                buf = buf[pos:] + chunk
+                pos = 0
+            else:
+                yield obj
+
+
+def iter_records(path, fields=None):
+    """
+    Yield records one at a time, optionally keeping only the named fields
+
+    Only the current record is held in memory, so memory use does not grow
+    with the size of the file.
+    """
+    if fields is None:
+        yield from iter_json_records(path)
+    else:
+        fields = list(fields)
+        for obj in iter_json_records(path):
+            yield {k: obj[k] for k in fields if k in obj}
+
+
+class RecordReader:
+    """
+    Random access by id-in-this-doc to records in a JSON Lines file
+
+    Uses the sidecar offset index (<filename>.idx) written by
+    combined2json.py --format jsonl and memory-maps the data file, so only
+    the requested records are parsed.
+    """
+
+    def __init__(self, path, index_path=None):
+        self.path = Path(path).expanduser().resolve()
+        if index_path is None:
+            index_path = self.path.with_name(self.path.name + ".idx")
+        with open(index_path, "r", encoding="utf-8") as fp:
+            self.offsets = json.load(fp)
+        del fp
+        logger.info(f"Read offsets for {len(self.offsets)} records from {index_path}")
+        self._fp = open(self.path, "rb")
+        if self.path.stat().st_size:
+            self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # an empty file cannot be memory-mapped, and has no records to get
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, obj_id):
+        return str(obj_id) in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+        self._fp.close()
+
+    def get(self, obj_id):
+        """Get a single record by id-in-this-doc."""
+        offset, length = self.offsets[str(obj_id)]
+        return json.loads(self._mm[offset : offset + length])
+
+    def get_many(self, obj_ids):
+        """Get records for several ids, reading them in file order."""
+        wanted = sorted(
+            {str(obj_id) for obj_id in obj_ids}, key=lambda i: self.offsets[i][0]
+        )
+        return {obj_id: self.get(obj_id) for obj_id in wanted}